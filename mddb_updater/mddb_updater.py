@@ -43,22 +43,38 @@
 
 import argparse
 import csv
+import glob
+import hashlib
+import io
+import json
 import logging
 import multiprocessing
 import os
 import re
+import time
 import urlparse
+import zlib
 from StringIO import StringIO
 
 import psycopg2
-import pyipmeta
-import radix
 import requests
 import wandio
 
+# NOTE: pyipmeta and radix are only needed for AS entities, and are imported when the asn scope is generated
+
 ipm = None
 GEO_PFX = 'geo.netacuity'
 
+# change sets with more rows than this are stored as counts only
+MAX_CHANGESET_ROWS = 100000
+
+# entity types generated by each scope, in generation order.
+# relationships between entities of two scopes are generated by, and belong to, the later scope.
+SCOPES = [
+    ("geo", ["continent", "country", "region", "county"]),
+    ("asn", ["asn"]),
+]
+
 
 def ipmeta_lookup(prefix):
     """
@@ -94,26 +110,64 @@ class MddbUpdater:
     This script takes in metadata files, like pfx2as and geolocation data, and commit it to a metadata database.
     """
 
-    def __init__(self):
+    def __init__(self, changeset_file=None, processes=None, run_log_days=30):
+        # JSON file the change set of each database update is written to
+        self.changeset_file = changeset_file
+        # days to keep change sets in the run log for
+        self.run_log_days = run_log_days
+        # number of ipmeta lookup processes, all CPUs by default
+        self.processes = processes or multiprocessing.cpu_count()
+        self._reset()
+
+    def _reset(self):
+        """
+        Reset all generated entities, ids and database rows.
+        """
         self.FQID_TO_ID = {}
         self.NEXT_ID = 0
+        # fqids of the entities that exist after the database update, i.e. that can be referred to
+        self.live_fqids = set()
         self.COUNTRY_NAMES = {}
         self.REGION_NAMES = {}
         self.ASN_INFO = {}
 
-        # entity types
+        # entity types, and the types of the entities generated in this run
         self.types = {}
+        self.logged_types = set()
 
         # entity type and attribute id counter
         self.next_type_id = 0
         self.next_attr_id = 0
 
+        # entity and attribute id increment, and the ASN shard (index, count) generated by this process
+        self.id_step = 1
+        self.shard = None
+
         # database rows saved as lists
         self.rows_entities = []
         self.rows_types = []
         self.rows_attributes = []
         self.rows_relationships = []
 
+        # geo (non-ASN) relationships and row counts, kept so that ASN entities can be regenerated on their own
+        self.geo_mappings = []
+        self.geo_marks = (0, 0, 0)
+
+    @staticmethod
+    def _format_rows(rows):
+        """
+        Format table rows as tab-separated text, as expected by postgres COPY.
+
+        :param rows: data rows content, list of lists
+        :return: unicode string of the rows
+        """
+        strs = []
+        for row in rows:
+            values = [unicode(v) for v in row]
+            row_str = "\t".join(values)
+            strs.append(row_str)
+        return u'\n'.join(strs)
+
     @staticmethod
     def _copy_into_table(cur, table, columns, rows):
         """
@@ -127,57 +181,123 @@ class MddbUpdater:
         """
         # convert data rows into a File-like object
         sio = StringIO()
-        strs = []
-        for row in rows:
-            values = [unicode(v) for v in row]
-            row_str = "\t".join(values)
-            strs.append(row_str)
-        sio.write('\n'.join(strs))
+        sio.write(MddbUpdater._format_rows(rows))
         sio.seek(0)
 
         # call postgres COPY command to write data into database in bulk
         # this is the most effective way
         cur.copy_from(sio, table, columns=columns)
 
-    def update_database(self):
+    @staticmethod
+    def _connect():
         """
-        Update metadata database content.
+        Connect to the metadata database defined by the DATABASE_URL environment variable.
+
+        :return: database connection
         """
-        logging.info("updating database now.")
-        # connect to database
         db_url_str = os.getenv("DATABASE_URL")
 
         parse_res = urlparse.urlparse(db_url_str)
         conn = psycopg2.connect("dbname='%s' user='%s' password='%s' host='%s'" %
                                 (parse_res.path[1:], parse_res.username, parse_res.password, parse_res.hostname))
         conn.autocommit = False
+        return conn
+
+    def load_ids(self, scope=None):
+        """
+        Load entity types and ids from the database, so that existing entities keep their ids and new entities
+        do not collide with them. Id counters are only ever increased.
+
+        :param scope: scope that is going to be regenerated (see SCOPES), entities outside of it are kept in the
+                      database and can be referred to by the generated entities
+        """
+        logging.info("loading existing ids from database.")
+        conn = self._connect()
         cur = conn.cursor()
 
-        # clear out existing tables
-
-        # The following SQL code block can safely delete all content in transaction:
-        #
-        # BEGIN;
-        #
-        # DELETE FROM mddb_entity_relationship;
-        # DELETE FROM mddb_entity_attribute;
-        # DELETE FROM mddb_entity;
-        # DELETE FROM mddb_entity_type;
-        #
-        # ROLLBACK;
-
-        logging.info("clearing tables first.")
-        for db in ["mddb_entity_relationship", "mddb_entity_attribute", "mddb_entity", "mddb_entity_type"]:
-            cur.execute("DELETE FROM %s" % db)
-        logging.info("tables cleared.")
-
-        # copy data into tables
-        # NOTE: the mddb_entity_type must be first filled due to forein-key constraints on the other tables
-        logging.info("writing new data")
-        self._copy_into_table(cur, "mddb_entity_type", ["id", "type"], self.rows_types)
-        self._copy_into_table(cur, "mddb_entity", ["id", "type_id", "code", "name"], self.rows_entities)
-        self._copy_into_table(cur, "mddb_entity_attribute", ["id", "metadata_id", "key", "value"], self.rows_attributes)
-        self._copy_into_table(cur, "mddb_entity_relationship", ["from_id", "to_id"], self.rows_relationships)
+        kept_types = []
+        if scope is not None:
+            kept_types = [t for (name, types) in SCOPES if name != scope for t in types]
+
+        cur.execute("SELECT id, type FROM mddb_entity_type")
+        for (type_id, type) in cur.fetchall():
+            self.types[type] = type_id
+        cur.execute("SELECT a.metadata_id, a.value, t.type FROM mddb_entity_attribute a "
+                    "JOIN mddb_entity e ON a.metadata_id = e.id JOIN mddb_entity_type t ON e.type_id = t.id "
+                    "WHERE a.key = 'fqid'")
+        for (entity_id, fqid, type) in cur.fetchall():
+            self.FQID_TO_ID[fqid] = entity_id
+            if type in kept_types:
+                self.live_fqids.add(fqid)
+
+        cur.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM mddb_entity_type")
+        self.next_type_id = max(self.next_type_id, cur.fetchone()[0])
+        cur.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM mddb_entity")
+        self.NEXT_ID = max(self.NEXT_ID, cur.fetchone()[0])
+        if scope is not None:
+            # attributes are all replaced in a full update, their ids can start over
+            cur.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM mddb_entity_attribute")
+            self.next_attr_id = max(self.next_attr_id, cur.fetchone()[0])
+
+        cur.close()
+        conn.close()
+        logging.info("loaded %d entity ids." % len(self.FQID_TO_ID))
+
+    def update_database(self, scope=None):
+        """
+        Update metadata database content.
+
+        :param scope: if set, only replace the entities of this scope (see SCOPES) and the relationships that belong
+                      to it, otherwise replace the content of all tables
+        """
+        logging.info("updating database now.")
+        # connect to database
+        conn = self._connect()
+        cur = conn.cursor()
+
+        self._hash_tables(cur, "mddb_prev", scope)
+
+        if scope is None:
+            # clear out existing tables
+
+            # The following SQL code block can safely delete all content in transaction:
+            #
+            # BEGIN;
+            #
+            # DELETE FROM mddb_entity_relationship;
+            # DELETE FROM mddb_entity_attribute;
+            # DELETE FROM mddb_entity;
+            # DELETE FROM mddb_entity_type;
+            #
+            # ROLLBACK;
+
+            logging.info("clearing tables first.")
+            for db in ["mddb_entity_relationship", "mddb_entity_attribute", "mddb_entity", "mddb_entity_type"]:
+                cur.execute("DELETE FROM %s" % db)
+            logging.info("tables cleared.")
+
+            # copy data into tables
+            # NOTE: the mddb_entity_type must be first filled due to forein-key constraints on the other tables
+            logging.info("writing new data")
+            self._copy_into_table(cur, "mddb_entity_type", ["id", "type"], self.rows_types)
+            self._copy_into_table(cur, "mddb_entity", ["id", "type_id", "code", "name"], self.rows_entities)
+            self._copy_into_table(cur, "mddb_entity_attribute", ["id", "metadata_id", "key", "value"],
+                                  self.rows_attributes)
+            self._copy_into_table(cur, "mddb_entity_relationship", ["from_id", "to_id"], self.rows_relationships)
+        else:
+            self._update_scope(cur, scope)
+
+        self._hash_tables(cur, "mddb_next", scope)
+        changeset = self._diff_tables(cur)
+        cur.execute("CREATE TABLE IF NOT EXISTS mddb_run_log ("
+                    "id SERIAL PRIMARY KEY, "
+                    "time TIMESTAMP NOT NULL DEFAULT now(), "
+                    "scope TEXT, "
+                    "changeset JSON NOT NULL)")
+        cur.execute("DELETE FROM mddb_run_log WHERE time < now() - %s * INTERVAL '1 day'", (self.run_log_days,))
+        cur.execute("INSERT INTO mddb_run_log (scope, changeset) VALUES (%s, %s) RETURNING id",
+                    (scope, json.dumps(changeset)))
+        run_id = cur.fetchone()[0]
 
         conn.commit()
         # close database connection
@@ -185,6 +305,160 @@ class MddbUpdater:
         conn.close()
         logging.info("database updated.")
 
+        if self.changeset_file is not None:
+            with open(self.changeset_file, "w") as fh:
+                json.dump(dict(changeset, run_id=run_id, scope=scope), fh)
+            logging.info("change set of run %d written to %s" % (run_id, self.changeset_file))
+
+    @staticmethod
+    def _scope_sql(scope):
+        """
+        Build the SQL selecting the entities of a scope and the relationships that belong to it.
+
+        :param scope: scope name
+        :return: entity id subquery, relationship condition, and their query parameters
+        """
+        scope_names = [name for (name, _) in SCOPES]
+        later_types = [t for (name, types) in SCOPES[scope_names.index(scope) + 1:] for t in types]
+        params = {"types": dict(SCOPES)[scope], "later_types": later_types}
+
+        scoped = "SELECT e.id FROM mddb_entity e JOIN mddb_entity_type t ON e.type_id = t.id " \
+                 "WHERE t.type = ANY(%(types)s)"
+        later = "SELECT e.id FROM mddb_entity e JOIN mddb_entity_type t ON e.type_id = t.id " \
+                "WHERE t.type = ANY(%(later_types)s)"
+        owned = "(from_id IN ({0}) AND to_id NOT IN ({1})) OR (to_id IN ({0}) AND from_id NOT IN ({1}))".format(
+            scoped, later)
+        return scoped, owned, params
+
+    def _hash_tables(self, cur, prefix, scope):
+        """
+        Snapshot the database content as MD5 hashes into temporary tables.
+
+        :param cur: database connection cursor
+        :param prefix: name prefix of the temporary tables
+        :param scope: if set, only snapshot the entities of this scope and the relationships that belong to it
+        """
+        entities = attributes = relationships = ""
+        params = {}
+        if scope is not None:
+            (scoped, owned, params) = self._scope_sql(scope)
+            entities = "WHERE e.id IN ({0})".format(scoped)
+            attributes = "WHERE a.metadata_id IN ({0})".format(scoped)
+            relationships = "WHERE {0}".format(owned)
+
+        cur.execute("CREATE TEMPORARY TABLE {0}_entity ON COMMIT DROP AS "
+                    "SELECT e.id, md5(concat_ws(E'\\t', t.type, e.code, e.name)) AS hash "
+                    "FROM mddb_entity e JOIN mddb_entity_type t ON e.type_id = t.id {1}".format(prefix, entities),
+                    params)
+        cur.execute("CREATE TEMPORARY TABLE {0}_attribute ON COMMIT DROP AS "
+                    "SELECT a.metadata_id AS id, a.key, md5(a.value::text) AS hash "
+                    "FROM mddb_entity_attribute a {1}".format(prefix, attributes), params)
+        cur.execute("CREATE TEMPORARY TABLE {0}_relationship ON COMMIT DROP AS "
+                    "SELECT from_id, to_id FROM mddb_entity_relationship {1}".format(prefix, relationships), params)
+
+    @staticmethod
+    def _diff_tables(cur):
+        """
+        Compute the change set between the mddb_prev and mddb_next snapshots made by _hash_tables.
+
+        Entities are listed by id, attributes by (entity id, key) and relationships by (from id, to id). Change
+        sets larger than MAX_CHANGESET_ROWS only list the number of changes, and are marked as truncated.
+
+        :param cur: database connection cursor
+        :return: change set dict
+        """
+        # build the diff queries, (table, change, key count, query)
+        queries = []
+        for (table, keys, hashed) in [
+            ("entity", ["id"], True),
+            ("attribute", ["id", "key"], True),
+            ("relationship", ["from_id", "to_id"], False),
+        ]:
+            join = " AND ".join(["n.{0} = p.{0}".format(key) for key in keys])
+            table_queries = [
+                ("added", "SELECT {0} FROM mddb_next_{1} n LEFT JOIN mddb_prev_{1} p ON {2} WHERE p.{3} IS NULL"),
+                ("removed", "SELECT {4} FROM mddb_prev_{1} p LEFT JOIN mddb_next_{1} n ON {2} WHERE n.{3} IS NULL"),
+            ]
+            if hashed:
+                table_queries.append(("modified", "SELECT {0} FROM mddb_next_{1} n JOIN mddb_prev_{1} p ON {2} "
+                                                  "WHERE n.hash <> p.hash"))
+            for (change, query) in table_queries:
+                queries.append((table, change, len(keys),
+                                query.format(", ".join(["n." + key for key in keys]), table, join, keys[0],
+                                             ", ".join(["p." + key for key in keys]))))
+
+        # count the changes first, so that large change sets are never fetched
+        counts = {}
+        for (table, change, _, query) in queries:
+            cur.execute("SELECT count(*) FROM ({0}) q".format(query))
+            counts.setdefault(table, {})[change] = cur.fetchone()[0]
+        for (table, table_counts) in counts.items():
+            logging.info("%s changes: %s" % (table, ", ".join(["%d %s" % (count, change)
+                                                              for (change, count) in table_counts.items()])))
+
+        total = sum([count for table_counts in counts.values() for count in table_counts.values()])
+        if total > MAX_CHANGESET_ROWS:
+            logging.info("%d changes, only storing counts" % total)
+            return {"truncated": True, "counts": counts}
+
+        changeset = {}
+        for (table, change, n_keys, query) in queries:
+            cur.execute(query)
+            if n_keys == 1:
+                changeset.setdefault(table, {})[change] = [row[0] for row in cur.fetchall()]
+            else:
+                changeset.setdefault(table, {})[change] = [list(row) for row in cur.fetchall()]
+        return dict(changeset, truncated=False, counts=counts)
+
+    def _update_scope(self, cur, scope):
+        """
+        Replace the entities of one scope in the database, leaving all other entities and their ids untouched.
+
+        Entities of the scope are updated in place, so that relationships belonging to later scopes stay valid.
+        Relationships belonging to later scopes are only removed if they point to entities that no longer exist.
+
+        :param cur: database connection cursor
+        :param scope: scope name
+        """
+        entity_types = dict(SCOPES)[scope]
+        (scoped, owned, params) = self._scope_sql(scope)
+
+        logging.info("replacing %s entities." % scope)
+
+        # new entity types
+        cur.execute("SELECT type FROM mddb_entity_type")
+        existing_types = set([row[0] for row in cur.fetchall()])
+        self._copy_into_table(cur, "mddb_entity_type", ["id", "type"],
+                              [row for row in self.rows_types if row[1] not in existing_types])
+
+        type_ids = set([self.types[t] for t in entity_types if t in self.types])
+        rows_entities = [row for row in self.rows_entities if row[1] in type_ids]
+        ids = set([row[0] for row in rows_entities])
+
+        cur.execute("CREATE TEMPORARY TABLE mddb_entity_new (LIKE mddb_entity) ON COMMIT DROP")
+        self._copy_into_table(cur, "mddb_entity_new", ["id", "type_id", "code", "name"], rows_entities)
+
+        vanished = scoped + " AND e.id NOT IN (SELECT id FROM mddb_entity_new)"
+
+        # relationships of this scope, and relationships of later scopes pointing to entities that are gone
+        cur.execute("DELETE FROM mddb_entity_relationship WHERE {0}".format(owned), params)
+        cur.execute("DELETE FROM mddb_entity_relationship "
+                    "WHERE from_id IN ({0}) OR to_id IN ({0})".format(vanished), params)
+        cur.execute("DELETE FROM mddb_entity_attribute WHERE metadata_id IN ({0})".format(scoped), params)
+        cur.execute("DELETE FROM mddb_entity WHERE id IN ({0})".format(vanished), params)
+        logging.info("%s entities cleared." % scope)
+
+        logging.info("writing new data")
+        cur.execute("UPDATE mddb_entity e SET type_id = n.type_id, code = n.code, name = n.name "
+                    "FROM mddb_entity_new n WHERE e.id = n.id")
+        cur.execute("INSERT INTO mddb_entity (id, type_id, code, name) "
+                    "SELECT id, type_id, code, name FROM mddb_entity_new "
+                    "WHERE id NOT IN (SELECT id FROM mddb_entity)")
+        self._copy_into_table(cur, "mddb_entity_attribute", ["id", "metadata_id", "key", "value"],
+                              [row for row in self.rows_attributes if row[1] in ids])
+        self._copy_into_table(cur, "mddb_entity_relationship", ["from_id", "to_id"],
+                              [row for row in self.rows_relationships if row[0] in ids or row[1] in ids])
+
     def _get_asn_info(self):
         """
         Get ASN info using PANDA API
@@ -216,12 +490,15 @@ class MddbUpdater:
                 raise err
 
     def getid(self, fqid, must_exist=False):
+        if must_exist:
+            # only refer to entities that are generated in this run or kept in the database
+            if fqid not in self.live_fqids:
+                return None
+            return self.FQID_TO_ID[fqid]
         if fqid in self.FQID_TO_ID:
             return self.FQID_TO_ID[fqid]
-        if must_exist:
-            return None
         entity_id = self.NEXT_ID
-        self.NEXT_ID += 1
+        self.NEXT_ID += self.id_step
         self.FQID_TO_ID[fqid] = entity_id
         return entity_id
 
@@ -249,17 +526,20 @@ class MddbUpdater:
             if type not in self.types:
                 # save new type
                 self.types[type] = self.next_type_id
-                self.rows_types.append((self.next_type_id, type))
                 self.next_type_id += 1
             type_id = self.types[type]
+            if type not in self.logged_types:
+                self.rows_types.append((type_id, type))
+                self.logged_types.add(type)
 
             # save entity
             self.rows_entities.append((id, type_id, code, name))
+            self.live_fqids.add(attrs['fqid'])
 
             # save attributes of the entity
             for key, val in list(attrs.items()):
                 self.rows_attributes.append((self.next_attr_id, id, key, val))
-                self.next_attr_id += 1
+                self.next_attr_id += self.id_step
         except ValueError as err:
             print(self.next_type_id, id, type, code, name, attrs)
             raise err
@@ -450,17 +730,41 @@ class MddbUpdater:
 
         return mappings
 
-    def _generate_ases(self, pfx2as, blocks, locations, polygon_mapping, regions, counties):
+    @staticmethod
+    def _load_ipmeta(blocks, locations, polygon_mapping, regions, counties):
         """
-        Generate AS entities.
-        :param pfx2as:
+        Initialize the pyipmeta lookup engine used for prefix geolocation.
+
         :param blocks:
         :param locations:
         :param polygon_mapping:
         :param regions:
         :param counties:
+        """
+        import pyipmeta
+
+        logging.info("Loading ipmeta geolocation data")
+        configs = [
+            "-b %s" % blocks,
+            "-l %s" % locations,
+            "-p %s" % polygon_mapping,
+            "-t %s" % regions,
+            "-t %s" % counties,
+        ]
+        global ipm
+        ipm = pyipmeta.IpMeta(provider="netacq-edge", provider_config=" ".join(configs))
+
+    def _generate_ases(self, pfx2as):
+        """
+        Generate AS entities.
+
+        NOTE: the ipmeta lookup engine must be loaded first with _load_ipmeta.
+
+        :param pfx2as:
         :return:
         """
+        import radix
+
         logging.info("Generating AS entities")
         mappings = []
 
@@ -477,28 +781,19 @@ class MddbUpdater:
                 origins = re.findall(r"\d+", origin)
 
                 for origin in origins:
+                    if self.shard is not None and self.shard_of(origin, self.shard[1]) != self.shard[0]:
+                        # processed by another shard
+                        continue
                     if origin not in asn_prefixes:
                         asn_prefixes[origin] = set()
                     prefixes.add(prefix)
                     asn_prefixes[origin].add(prefix)
 
-        # initialize pyipmeta
-        configs = [
-            "-b %s" % blocks,
-            "-l %s" % locations,
-            "-p %s" % polygon_mapping,
-            "-t %s" % regions,
-            "-t %s" % counties,
-        ]
-        global ipm
-        ipm = pyipmeta.IpMeta(provider="netacq-edge", provider_config=" ".join(configs))
-
         # ipmeta-lookup for all prefixes.
         # multi-threaded.
         prefix_geo = {}
-        cpu_count = multiprocessing.cpu_count()
-        logging.info("launching %d processes to do ipmeta lookup" % cpu_count)
-        pool = multiprocessing.Pool(cpu_count)
+        logging.info("launching %d processes to do ipmeta lookup" % self.processes)
+        pool = multiprocessing.Pool(self.processes)
         # actually lookup tasks are distributed here
         pfxgeo_items = pool.map(ipmeta_lookup, prefixes)
         for prefix, pfxgeo in pfxgeo_items:
@@ -577,8 +872,355 @@ class MddbUpdater:
 
         logging.info("api validation successful on %s" % api_endpoint)
 
+    def _log_mappings(self, mappings):
+        """
+        Save (from_id, to_id) mappings as relationship rows in both directions.
+
+        :param mappings: forward-direction mappings
+        """
+        for mapping in mappings:
+            self.rows_relationships.append((mapping[0], mapping[1]))
+            self.rows_relationships.append((mapping[1], mapping[0]))
+
+    def _generate_geo(self, country_codes, region_polygons, county_polygons):
+        """
+        Generate all geo entities (continents, countries, regions and counties).
+
+        :param country_codes:
+        :param region_polygons:
+        :param county_polygons:
+        """
+        # mappings is array of (from_id, to_id) mappings
+        # but only in the forward direction.
+        mappings = []
+        mappings.extend(self._generate_continents())
+        mappings.extend(self._generate_countries(country_codes))
+        mappings.extend(self._generate_regions(region_polygons))
+        mappings.extend(self._generate_counties(county_polygons))
+
+        self.geo_mappings = mappings
+        self.geo_marks = (len(self.rows_entities), len(self.rows_attributes), self.next_attr_id)
+        self._log_mappings(mappings)
+
+    def _reload_geo(self, country_codes, region_polygons, county_polygons):
+        """
+        Regenerate all geo entities from a clean state, keeping the ids in the database.
+
+        :param country_codes:
+        :param region_polygons:
+        :param county_polygons:
+        """
+        self._reset()
+        self.load_ids()
+        self._generate_geo(country_codes, region_polygons, county_polygons)
+
+    def _reset_ases(self):
+        """
+        Drop previously generated AS entities, attributes and relationships, keeping the geo entities.
+
+        AS ids are kept in FQID_TO_ID so that ASNs keep their ids across regenerations.
+        """
+        (n_entities, n_attributes, next_attr_id) = self.geo_marks
+        del self.rows_entities[n_entities:]
+        del self.rows_attributes[n_attributes:]
+        self.next_attr_id = next_attr_id
+        self.rows_relationships = []
+        self._log_mappings(self.geo_mappings)
+
+    @staticmethod
+    def _fingerprint(path):
+        """
+        Fingerprint a data file to detect changes.
+
+        Local files are fingerprinted by their modification time and size, swift objects by their ETag and
+        last modification time, and other remote files by the MD5 of their content.
+
+        :param path: local path or wandio-supported URL
+        :return: fingerprint of the file content
+        """
+        if os.path.exists(path):
+            stat = os.stat(path)
+            return stat.st_mtime, stat.st_size
+        if path.startswith("swift://"):
+            # swiftclient is only needed (and installed along with wandio) when reading data files from swift
+            import swiftclient.service
+            (container, obj) = path[len("swift://"):].split("/", 1)
+            with swiftclient.service.SwiftService() as swift:
+                for res in swift.stat(container=container, objects=[obj]):
+                    if not res["success"]:
+                        raise res["error"]
+                    return res["headers"].get("etag"), res["headers"].get("last-modified")
+        md5 = hashlib.md5()
+        with wandio.open(path) as fh:
+            for line in fh:
+                md5.update(line)
+        return md5.hexdigest()
+
+    @staticmethod
+    def _latest_pfx2as(watch_dir, min_age):
+        """
+        Find the most recently modified pfx2as file in a local directory.
+
+        Files modified less than min_age seconds ago are skipped, as they may still be being written.
+
+        :param watch_dir: directory to look for *.pfx2as.gz files in
+        :param min_age: minimum seconds since the last modification of a file
+        :return: path to the newest pfx2as file, or None if there is none
+        """
+        now = time.time()
+        files = [f for f in glob.glob(os.path.join(watch_dir, "*.pfx2as.gz")) if now - os.path.getmtime(f) >= min_age]
+        if not files:
+            return None
+        return max(files, key=os.path.getmtime)
+
+    def _geo_ids_match(self):
+        """
+        Check that the entity types and geo entity ids in the database are the ones held in memory, i.e. that
+        nothing else has renumbered them since they were published.
+
+        :return: True if the ids match
+        """
+        (_, n_attributes, _) = self.geo_marks
+        geo_ids = dict([(row[3], row[1]) for row in self.rows_attributes[:n_attributes] if row[2] == 'fqid'])
+
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute("SELECT id, type FROM mddb_entity_type")
+        types = dict([(type, type_id) for (type_id, type) in cur.fetchall()])
+        cur.execute("SELECT a.value, a.metadata_id FROM mddb_entity_attribute a "
+                    "JOIN mddb_entity e ON a.metadata_id = e.id JOIN mddb_entity_type t ON e.type_id = t.id "
+                    "WHERE a.key = 'fqid' AND t.type = ANY(%s)", (dict(SCOPES)["geo"],))
+        db_geo_ids = dict(cur.fetchall())
+        cur.close()
+        conn.close()
+
+        return db_geo_ids == geo_ids and all([types.get(t) == type_id for (t, type_id) in self.types.items()])
+
+    def run_daemon(self, country_codes, region_polygons, county_polygons, pfx2as,
+                   blocks, locations, polygon_mapping, api_url,
+                   watch_dir=None, interval=300, reload_interval=3600):
+        """
+        Daemon entry point function.
+
+        Keeps geo entities and the ipmeta lookup engine in memory, and regenerates and republishes only the AS
+        entities whenever a new pfx2as file shows up. Changes to the geo and NetAcq files are checked every
+        reload_interval seconds and are hot-reloaded. Ids are reconciled with the database before each
+        publication, in case another updater run changed them.
+
+        :param country_codes:
+        :param region_polygons:
+        :param county_polygons:
+        :param pfx2as: pfx2as file to poll for changes, used if watch_dir is not set
+        :param blocks:
+        :param locations:
+        :param polygon_mapping:
+        :param api_url:
+        :param watch_dir: local directory to watch for new pfx2as files
+        :param interval: seconds between pfx2as checks
+        :param reload_interval: seconds between geo and NetAcq file checks
+        """
+        logging.info("Starting daemon, checking for new pfx2as data every %d seconds" % interval)
+
+        geo_files = [country_codes, region_polygons, county_polygons]
+        ipmeta_files = [blocks, locations, polygon_mapping, region_polygons, county_polygons]
+        geo_fp = None
+        ipmeta_fp = None
+        pfx2as_fp = None
+        last_reload = None
+        # geo entities changed since the last publication, the whole database needs to be replaced
+        publish_all = True
+
+        while True:
+            try:
+                if last_reload is None or time.time() - last_reload >= reload_interval:
+                    fp = [self._fingerprint(f) for f in geo_files]
+                    if fp != geo_fp:
+                        logging.info("geo files changed, reloading geo entities")
+                        self._reload_geo(country_codes, region_polygons, county_polygons)
+                        geo_fp = fp
+                        publish_all = True
+                    fp = [self._fingerprint(f) for f in ipmeta_files]
+                    if fp != ipmeta_fp:
+                        logging.info("geolocation files changed, reloading ipmeta")
+                        self._load_ipmeta(blocks, locations, polygon_mapping, region_polygons, county_polygons)
+                        ipmeta_fp = fp
+                        # AS geolocation needs to be redone
+                        pfx2as_fp = None
+                    last_reload = time.time()
+
+                cur_pfx2as = self._latest_pfx2as(watch_dir, interval) if watch_dir is not None else pfx2as
+                if cur_pfx2as is None:
+                    logging.info("no complete pfx2as file found in %s" % watch_dir)
+                else:
+                    fp = (cur_pfx2as, self._fingerprint(cur_pfx2as))
+                    if publish_all or fp != pfx2as_fp:
+                        logging.info("Refreshing AS entities from %s" % cur_pfx2as)
+                        if not publish_all and not self._geo_ids_match():
+                            logging.info("ids in database changed, reloading geo entities")
+                            self._reload_geo(country_codes, region_polygons, county_polygons)
+                            publish_all = True
+                        self._reset_ases()
+                        if not publish_all:
+                            # pick up AS ids and id counters from the database
+                            self.load_ids("asn")
+                        self._log_mappings(self._generate_ases(cur_pfx2as))
+                        self.update_database(None if publish_all else "asn")
+                        publish_all = False
+                        pfx2as_fp = fp
+                        self.validate_api(api_url)
+            except Exception as err:
+                # keep the daemon alive, the failed step is retried on the next iteration
+                logging.exception("refresh failed: %s" % err)
+
+            time.sleep(interval)
+
+    @staticmethod
+    def shard_of(asn, num_shards):
+        """
+        Find the shard an ASN is processed by.
+
+        :param asn: ASN string
+        :param num_shards: total number of shards
+        :return: shard index
+        """
+        return (zlib.crc32(asn) & 0xffffffff) % num_shards
+
+    def generate_shard(self, country_codes, region_polygons, county_polygons, pfx2as,
+                       blocks, locations, polygon_mapping, shard, num_shards, output_dir):
+        """
+        Shard worker entry point function.
+
+        Generates the AS entities of one shard of the ASNs and writes them to output_dir, to be loaded into the
+        database by merge_shards. Geo entities are generated identically by every shard and only written by shard
+        0, entity types are written by every shard. AS entity and attribute ids are interleaved between shards
+        (i.e., shard k uses ids base + k, base + k + n, ...), so that ids never collide. Each shard also writes a
+        manifest of its id bases, which merge_shards checks to be the same for all shards.
+
+        :param country_codes:
+        :param region_polygons:
+        :param county_polygons:
+        :param pfx2as:
+        :param blocks:
+        :param locations:
+        :param polygon_mapping:
+        :param shard: index of the shard to generate, from 0 to num_shards - 1
+        :param num_shards: total number of shards
+        :param output_dir: directory to write the shard output files to
+        """
+        logging.info("Generating shard %d of %d" % (shard, num_shards))
+
+        # all shards load the same ids, so that they generate the same geo entities
+        self.load_ids()
+        # register all entity types first, so that their ids do not depend on the ASNs of the shard
+        for (_, types) in SCOPES:
+            for type in types:
+                if type not in self.types:
+                    self.types[type] = self.next_type_id
+                    self.next_type_id += 1
+        self._generate_geo(country_codes, region_polygons, county_polygons)
+
+        (n_entities, n_attributes, _) = self.geo_marks
+        manifest = {
+            "num_shards": num_shards,
+            "next_id": self.NEXT_ID,
+            "next_attr_id": self.next_attr_id,
+            "geo_entities": n_entities,
+            "geo_digest": hashlib.md5(self._format_rows(self.rows_entities).encode("utf-8")).hexdigest(),
+            "types": self.types,
+        }
+
+        self.shard = (shard, num_shards)
+        self.id_step = num_shards
+        self.NEXT_ID += shard
+        self.next_attr_id += shard
+
+        self._load_ipmeta(blocks, locations, polygon_mapping, region_polygons, county_polygons)
+        self._log_mappings(self._generate_ases(pfx2as))
+
+        # shard 0 writes the geo entities, the others only their own AS entities.
+        # all shards write their entity types, as shard 0 may not have any AS entity.
+        if shard != 0:
+            del self.rows_entities[:n_entities]
+            del self.rows_attributes[:n_attributes]
+            del self.rows_relationships[:2 * len(self.geo_mappings)]
+
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        for (table, rows) in [
+            ("mddb_entity_type", self.rows_types),
+            ("mddb_entity", self.rows_entities),
+            ("mddb_entity_attribute", self.rows_attributes),
+            ("mddb_entity_relationship", self.rows_relationships),
+        ]:
+            path = os.path.join(output_dir, "%s.%d-of-%d.tsv" % (table, shard, num_shards))
+            with io.open(path, "w", encoding="utf-8") as fh:
+                fh.write(self._format_rows(rows))
+        with open(os.path.join(output_dir, "manifest.%d-of-%d.json" % (shard, num_shards)), "w") as fh:
+            json.dump(manifest, fh)
+        logging.info("shard %d of %d written to %s" % (shard, num_shards, output_dir))
+
+    def merge_shards(self, input_dir, api_url):
+        """
+        Shard merge entry point function.
+
+        Loads the output files of all shard workers in input_dir and replaces the database content with them.
+        Refuses to load shards of different runs, i.e. if input_dir holds shards of more than one shard count, or
+        if the shard manifests do not agree on the id bases, geo entities and entity types.
+
+        :param input_dir: directory containing the shard output files
+        :param api_url:
+        """
+        logging.info("Merging shards from %s" % input_dir)
+
+        files = glob.glob(os.path.join(input_dir, "*.*-of-*.*"))
+        shard_counts = set([int(m.group(1)) for m in [re.search(r"-of-(\d+)\.(tsv|json)$", f) for f in files] if m])
+        if not shard_counts:
+            raise ValueError("no shard files found in %s" % input_dir)
+        if len(shard_counts) != 1:
+            raise ValueError("shard files of different shard counts (%s) found in %s" %
+                             (", ".join([str(n) for n in sorted(shard_counts)]), input_dir))
+        num_shards = shard_counts.pop()
+
+        manifests = []
+        for shard in range(num_shards):
+            path = os.path.join(input_dir, "manifest.%d-of-%d.json" % (shard, num_shards))
+            if not os.path.exists(path):
+                raise ValueError("missing shard manifest %s" % path)
+            with open(path) as fh:
+                manifests.append(json.load(fh))
+        for (shard, manifest) in enumerate(manifests):
+            if manifest != manifests[0]:
+                raise ValueError("manifest of shard %d does not match shard 0, shards were generated from "
+                                 "different database states: %s != %s" % (shard, manifest, manifests[0]))
+
+        for (table, rows) in [
+            ("mddb_entity_type", self.rows_types),
+            ("mddb_entity", self.rows_entities),
+            ("mddb_entity_attribute", self.rows_attributes),
+            ("mddb_entity_relationship", self.rows_relationships),
+        ]:
+            for shard in range(num_shards):
+                path = os.path.join(input_dir, "%s.%d-of-%d.tsv" % (table, shard, num_shards))
+                if not os.path.exists(path):
+                    raise ValueError("missing shard output file %s" % path)
+                with io.open(path, encoding="utf-8") as fh:
+                    for line in fh:
+                        line = line.rstrip("\n")
+                        if line:
+                            rows.append(line.split("\t"))
+        # entity types are written by every shard
+        rows_types = []
+        for row in self.rows_types:
+            if row not in rows_types:
+                rows_types.append(row)
+        self.rows_types = rows_types
+        logging.info("Merged %d entities from %d shards" % (len(self.rows_entities), num_shards))
+
+        self.update_database()
+        self.validate_api(api_url)
+
     def generate_entities(self, country_codes, region_polygons, county_polygons, pfx2as,
-                          blocks, locations, polygon_mapping, api_url):
+                          blocks, locations, polygon_mapping, api_url, only=None):
         """
         Entry point function.
 
@@ -589,28 +1231,22 @@ class MddbUpdater:
         :param blocks:
         :param locations:
         :param polygon_mapping:
+        :param only: if set, only generate and replace the entities of this scope (see SCOPES)
         :return:
         """
         logging.info("Extracting Entities from: %s, %s, %s, %s" %
                      (country_codes, region_polygons, county_polygons, pfx2as))
 
-        mappings = []
+        # keep ids of existing entities, so that only the entities that actually changed are in the change set
+        self.load_ids(only)
 
-        # mappings is array of (from_id, to_id) mappings
-        # but only in the forward direction.
-        mappings.extend(self._generate_continents())
-        mappings.extend(self._generate_countries(country_codes))
-        mappings.extend(self._generate_regions(region_polygons))
-        mappings.extend(self._generate_counties(county_polygons))
-        mappings.extend(self._generate_ases(pfx2as, blocks, locations,
-                                            polygon_mapping, region_polygons,
-                                            county_polygons))
-
-        for mapping in mappings:
-            self.rows_relationships.append((mapping[0], mapping[1]))
-            self.rows_relationships.append((mapping[1], mapping[0]))
+        if only in (None, "geo"):
+            self._generate_geo(country_codes, region_polygons, county_polygons)
+        if only in (None, "asn"):
+            self._load_ipmeta(blocks, locations, polygon_mapping, region_polygons, county_polygons)
+            self._log_mappings(self._generate_ases(pfx2as))
 
-        self.update_database()
+        self.update_database(only)
         self.validate_api(api_url)
 
 
@@ -665,10 +1301,96 @@ def main():
                         help='Endpoint API URL for testing (e.g. https://api.ioda.caida.org/test)',
                         default=None)
 
+    parser.add_argument('-o', '--only',
+                        nargs='?', required=False,
+                        choices=[name for (name, _) in SCOPES],
+                        help='Only refresh entities of this scope, keeping the ids of all other entities',
+                        default=None)
+
+    # sharded mode
+    parser.add_argument('-s', '--shard',
+                        nargs='?', required=False,
+                        help='Only generate AS entities of shard K of N (e.g. 0/4), and write them to --output-dir '
+                             'instead of the database',
+                        default=None)
+
+    parser.add_argument('-O', '--output-dir',
+                        nargs='?', required=False,
+                        help='Directory to write shard output files to',
+                        default=None)
+
+    parser.add_argument('-n', '--processes',
+                        required=False, type=int,
+                        help='Number of processes to do ipmeta lookups with (default: number of CPUs)',
+                        default=None)
+
+    parser.add_argument('-m', '--merge',
+                        nargs='?', required=False,
+                        help='Load the shard output files in this directory into the database',
+                        default=None)
+
+    parser.add_argument('-X', '--changeset-file',
+                        nargs='?', required=False,
+                        help='JSON file to write the change set of the database update to',
+                        default=None)
+
+    parser.add_argument('-L', '--run-log-days',
+                        required=False, type=int,
+                        help='Days to keep change sets in the mddb_run_log table',
+                        default=30)
+
+    # daemon mode
+    parser.add_argument('-d', '--daemon',
+                        action='store_true', required=False,
+                        help='Keep running and refresh AS entities whenever new pfx2as data is available')
+
+    parser.add_argument('-w', '--watch-dir',
+                        nargs='?', required=False,
+                        help='Local directory to watch for new *.pfx2as.gz files in daemon mode '
+                             '(default: poll the --pfx2as file)',
+                        default=None)
+
+    parser.add_argument('-i', '--interval',
+                        required=False, type=int,
+                        help='Seconds between checks for new pfx2as data in daemon mode',
+                        default=300)
+
+    parser.add_argument('-R', '--reload-interval',
+                        required=False, type=int,
+                        help='Seconds between checks for new geo and NetAcq data in daemon mode',
+                        default=3600)
+
     opts = vars(parser.parse_args())
+    only = opts.pop("only")
+    daemon = opts.pop("daemon")
+    daemon_opts = {
+        "watch_dir": opts.pop("watch_dir"),
+        "interval": opts.pop("interval"),
+        "reload_interval": opts.pop("reload_interval"),
+    }
+    changeset_file = opts.pop("changeset_file")
+    processes = opts.pop("processes")
+    run_log_days = opts.pop("run_log_days")
+    shard = opts.pop("shard")
+    output_dir = opts.pop("output_dir")
+    merge_dir = opts.pop("merge")
+    if daemon and only is not None:
+        logging.error("'only' parameter is not supported in daemon mode")
+        exit(1)
+    if (shard is not None or merge_dir is not None) and (daemon or only is not None):
+        logging.error("'shard' and 'merge' parameters are not supported with 'daemon' or 'only'")
+        exit(1)
+    if shard is not None:
+        match = re.match(r"^(\d+)/(\d+)$", shard)
+        if match is None or int(match.group(1)) >= int(match.group(2)):
+            logging.error("'shard' parameter must be K/N, with 0 <= K < N")
+            exit(1)
+        if output_dir is None:
+            logging.error("missing 'output-dir' parameter for shard output")
+            exit(1)
 
     # check swift credentials
-    if any([opt is not None and "swift" in opt for opt in opts.values()]):
+    if merge_dir is None and any([opt is not None and "swift" in opt for opt in opts.values()]):
         # only check swift environment variable credentials if we are using datafiles from swift.
         # the variables are defined in pairs for showing what variables are missing, if any.
         envs = [
@@ -690,14 +1412,24 @@ def main():
     if os.getenv("DATABASE_URL") is None:
         logging.error("missing DATABASE_URL environment variable to access metadata databse")
         exit(1)
-    # check api URL
-    if opts["api_url"] is None and os.getenv("API_URL") is None:
-        logging.error("missing API_URL environment variable or 'api-url' parameter")
-        exit(1)
+    # check api URL, shard workers do not write to the database and do not validate the api
+    if shard is None:
+        if opts["api_url"] is None and os.getenv("API_URL") is None:
+            logging.error("missing API_URL environment variable or 'api-url' parameter")
+            exit(1)
 
 
-    updater = MddbUpdater()
-    updater.generate_entities(**opts)
+    updater = MddbUpdater(changeset_file=changeset_file, processes=processes, run_log_days=run_log_days)
+    if shard is not None:
+        opts.pop("api_url")
+        (shard, num_shards) = [int(v) for v in shard.split("/")]
+        updater.generate_shard(shard=shard, num_shards=num_shards, output_dir=output_dir, **opts)
+    elif merge_dir is not None:
+        updater.merge_shards(merge_dir, opts["api_url"])
+    elif daemon:
+        updater.run_daemon(**dict(opts, **daemon_opts))
+    else:
+        updater.generate_entities(only=only, **opts)
 
 
 if __name__ == "__main__":